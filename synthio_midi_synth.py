@@ -10,6 +10,7 @@
 # - vibrato depth on mod wheel (midi controller 1)
 #
 import time, random
+import micropython
 import board
 import audiobusio, audiomixer
 import synthio
@@ -31,17 +32,34 @@ lck_pin, bck_pin, dat_pin  = board.MISO, board.MOSI, board.SCK
 SAMPLE_RATE = 28000  # clicks @ 36kHz & 48kHz on rp2040
 SAMPLE_SIZE = 256    # we like powers of two
 VOLUME = 12000       # 16384 is max volume I think
+# waveforms must stay int16: synthio rejects any waveform buffer not of type 'h', so no int8 tables
 wave_saw = np.linspace(VOLUME, -VOLUME, num=SAMPLE_SIZE, dtype=np.int16)
-wave_squ = np.concatenate((np.ones(SAMPLE_SIZE//2, dtype=np.int16)*VOLUME,np.ones(SAMPLE_SIZE//2, dtype=np.int16)*-VOLUME))
+wave_squ = np.zeros(SAMPLE_SIZE, dtype=np.int16)  # fill halves in place, no concatenate temporaries
+wave_squ[:SAMPLE_SIZE//2] = VOLUME
+wave_squ[SAMPLE_SIZE//2:] = -VOLUME
 wave_sin = np.array(np.sin(np.linspace(0, 4*np.pi, SAMPLE_SIZE, endpoint=False)) * VOLUME, dtype=np.int16)
-wave_noise = np.array([random.randint(-VOLUME, VOLUME) for i in range(SAMPLE_SIZE)], dtype=np.int16)
-wave_sin_dirty = np.array( wave_sin + (wave_noise/4), dtype=np.int16)
+
+@micropython.viper
+def fill_noise(buf:ptr16, n:int, vol:int, seed:int):
+    # xorshift32 noise, fills int16 buffer with values in -vol..vol (scaled by multiply+shift, viper has no %)
+    x = uint(seed) | 1
+    for i in range(n):
+        x ^= x << 13
+        x ^= x >> 17
+        x ^= x << 5
+        buf[i] = int(((x >> 16) * uint(2*vol+1)) >> 16) - vol
+
+noise_buf = bytearray(SAMPLE_SIZE*2)
+fill_noise(noise_buf, SAMPLE_SIZE, VOLUME, random.randint(1, 0x7fff))
+wave_noise = np.frombuffer(noise_buf, dtype=np.int16)
+wave_sin_dirty = wave_sin + wave_noise // 4  # stays int16, no float temporary
 waveforms = (wave_saw, wave_squ, wave_sin, wave_sin_dirty, wave_noise)
 
 synth = synthio.Synthesizer(sample_rate=SAMPLE_RATE)  # note: no envelope or waveform, we do that in Note now!
+MIDI_HZ = tuple(synthio.midi_to_hz(n) for n in range(128))  # note number -> frequency
 audio = audiobusio.I2SOut(bit_clock=bck_pin, word_select=lck_pin, data=dat_pin)
 mixer = audiomixer.Mixer(voice_count=1, sample_rate=SAMPLE_RATE, channel_count=1,
-                         bits_per_sample=16, samples_signed=True, buffer_size=2048 ) # buffer_size=4096 )
+                         bits_per_sample=16, samples_signed=True, buffer_size=4096 ) # fewer refills, more GC headroom
 audio.play(mixer)           # attach mixer to DAC
 mixer.voice[0].play(synth)  # start synth engine playing
 
@@ -49,60 +67,124 @@ wave_i = 0  # which waveform to play
 num_oscs = 1  # how many oscillators per note
 max_oscs = 5
 osc_detune = 0.01 # how much detune (fatness)
+DETUNE = tuple(1 + osc_detune*i for i in range(max_oscs+1))  # per-oscillator freq multiplier, bound into note_on at def time
 
-notes_pressed = {}  # which notes are currently being pressed, and their note objects (so we can unpress them)
+notes_pressed = [None]*128  # indexed by note number: which notes are currently being pressed, and their note objects (so we can unpress them)
 mod_val = 0  # ranges 0-1
+vib_lfo = synthio.LFO(rate=20*mod_val, scale=0.5*mod_val)  # vibrato shared by all notes, set by mod wheel
+debug_notes = False  # print MIDI events, off by default since print() stalls the loop
+RELEASE_TIME = 0.8  # amp envelope release, a released Note isn't reused until this has passed
+POOL_SIZE = 32  # released notes lists kept for reuse, extra releases are left to the GC
+pool_notes = [None]*POOL_SIZE  # ring buffer of released notes lists, oldest at pool_head
+pool_times = [0]*POOL_SIZE  # time.monotonic() at which each pooled list was released
+pool_head = 0
+pool_count = 0
+env_cache = {}  # velocity bucket -> Envelope, so repeated notes don't allocate new ones
 
-def note_on(notenum, vel):
+def make_envelope(bucket):
+    vel = bucket*8 + 4  # bucket centre, so quantization error averages out
     at_time = max(0, 2 * (127-(vel*1.2)) / 127) # velocity controls attack time
-    amp_env = synthio.Envelope(attack_time=at_time, decay_time=0.05, release_time=0.8,
-                               attack_level=1, sustain_level=0.8)
-    waveform = waveforms[wave_i]
-    notes = []
-    f = synthio.midi_to_hz(notenum)
-    for i in range(num_oscs):
+    return synthio.Envelope(attack_time=at_time, decay_time=0.05, release_time=RELEASE_TIME,
+                            attack_level=1, sustain_level=0.8)
+
+@micropython.native
+def note_on(notenum, vel, _Note=synthio.Note, _rand=random.random, _waveforms=waveforms,
+            _env_cache=env_cache, _vib_lfo=vib_lfo, _pool_notes=pool_notes, _pool_times=pool_times,
+            _detune=DETUNE, _midi_hz=MIDI_HZ, _synth=synth, _notes_pressed=notes_pressed):
+    # defaults are bound once: changing osc_detune needs a new DETUNE passed in
+    global pool_head, pool_count
+    n_oscs, debug, release_time = num_oscs, debug_notes, RELEASE_TIME  # read globals once
+    bucket = vel >> 3  # 16 velocity buckets
+    amp_env = _env_cache.get(bucket)
+    if amp_env is None:
+        amp_env = _env_cache[bucket] = make_envelope(bucket)
+    waveform = _waveforms[wave_i]
+    if pool_count and time.monotonic() - _pool_times[pool_head] >= release_time:  # oldest release tail is done
+        notes = _pool_notes[pool_head]
+        _pool_notes[pool_head] = None
+        pool_head = (pool_head + 1) % POOL_SIZE
+        pool_count -= 1
+        del notes[n_oscs:]  # num_oscs may have dropped since it was pressed
+    else:
+        notes = []
+    n_reused = len(notes)
+    f = _midi_hz[notenum]
+    for i in range(n_oscs):
         #  add detuning to oscillators + a bit of random so phases w/ other notes don't perfectly align
-        fr = f * (1 + (osc_detune*i) + (random.random()/1000) )
-        print("fr:",fr)
-        notes.append( synthio.Note( frequency=fr, envelope=amp_env, waveform=waveform,
-                                    bend_mode=synthio.BendMode.VIBRATO,
-                                    bend_depth = 0.5 * mod_val, bend_rate = 20 * mod_val ) )
-    notes_pressed[notenum] = notes
-    synth.press(notes)
+        #  (these must stay separate Notes: a single-cycle table of summed, phase-shifted copies is
+        #  still one frequency, so it can't produce the beating that detune gives)
+        fr = f * (_detune[i] + _rand()*0.001)
+        if debug: print("fr:",fr)
+        if i < n_reused:
+            n = notes[i]
+            n.frequency, n.envelope, n.waveform = fr, amp_env, waveform
+        else:
+            notes.append( _Note( frequency=fr, envelope=amp_env, waveform=waveform, bend=_vib_lfo ) )
+    _notes_pressed[notenum] = notes
+    _synth.press(notes)
 
 def note_off(notenum,vel):
-    notes = notes_pressed.get(notenum, None)
+    global pool_count
+    notes = notes_pressed[notenum]
     if notes:
         synth.release(notes)
-        del notes_pressed[notenum]
+        notes_pressed[notenum] = None
+        if pool_count < POOL_SIZE:  # keep the whole list, one timestamp per release
+            i = (pool_head + pool_count) % POOL_SIZE
+            pool_notes[i] = notes
+            pool_times[i] = time.monotonic()
+            pool_count += 1
+
+def handle_note_on(msg):
+    if cc_latest: flush_cc()  # sliders set before this note must affect it
+    if msg.velocity == 0:  # NoteOn w/ vel 0 is a NoteOff
+        handle_note_off(msg)
+        return
+    if debug_notes: print("noteOn: ", msg.note, "vel=", msg.velocity)
+    led.fill(0xff00ff)
+    note_on( msg.note, msg.velocity)
+    if debug_notes: print("notes_pressed:", [i for i, n in enumerate(notes_pressed) if n])
+
+def handle_note_off(msg):
+    if cc_latest: flush_cc()
+    if debug_notes: print("noteOff:", msg.note, "vel=", msg.velocity)
+    led.fill(0x00000)
+    note_off( msg.note, msg.velocity)
+    if debug_notes: print("notes_pressed:", [i for i, n in enumerate(notes_pressed) if n])
+
+def handle_cc(control, value):
+    global mod_val, num_oscs, wave_i
+    if debug_notes: print("controlChange", control, "=", value)
+    if control == 1: # mod wheel
+        mod_val = value / 127
+        vib_lfo.scale = 0.5 * mod_val  # all notes share vib_lfo, so no per-note updates
+        vib_lfo.rate = 20 * mod_val
+    elif control == 82:  # leftmost slider on minilab3
+        num_oscs = int( 1 + (value/127) * max_oscs )
+        if debug_notes: print("num_oscs:",num_oscs)
+    elif control == 83:  # leftmost+1 slider on minilab3
+        wave_i = int( (value/127) * (len(waveforms)-1) )
+        if debug_notes: print("wave_i:",wave_i)
 
-debug_notes = False
+cc_latest = {}  # control number -> last value received, so a burst of CCs is applied once
+
+def queue_cc(msg):
+    cc_latest[msg.control] = msg.value
+
+def flush_cc():
+    for control, value in cc_latest.items():
+        handle_cc(control, value)
+    cc_latest.clear()
+
+def handle_none(msg):
+    pass
+
+# message class -> handler, one dict lookup per message instead of an isinstance chain
+msg_handlers = {NoteOn: handle_note_on, NoteOff: handle_note_off, ControlChange: queue_cc}
 
 print("synthio_midi_synth ready")
 while True:
-    msg = midi.receive()
-    if isinstance(msg, NoteOn) and msg.velocity != 0:
-        print("noteOn: ", msg.note, "vel=", msg.velocity)
-        led.fill(0xff00ff)
-        note_on( msg.note, msg.velocity)
-        if debug_notes: print("notes_pressed:", notes_pressed)
-    elif isinstance(msg,NoteOff) or isinstance(msg,NoteOn) and msg.velocity==0:
-        print("noteOff:", msg.note, "vel=", msg.velocity)
-        led.fill(0x00000)
-        note_off( msg.note, msg.velocity)
-        if debug_notes: print("notes_pressed:", notes_pressed)
-    elif isinstance(msg,ControlChange):
-        print("controlChange", msg.control, "=", msg.value)
-        if msg.control == 1: # mod wheel
-            mod_val = msg.value / 127
-            for notes in notes_pressed.values():
-                for n in notes:  # adjust vibrato depth & rate for all notes
-                    n.bend_depth = 0.5 * mod_val
-                    n.bend_rate = 20 * mod_val
-        elif msg.control == 82:  # leftmost slider on minilab3
-            num_oscs = int( 1 + (msg.value/127) * max_oscs )
-            print("num_oscs:",num_oscs)
-        elif msg.control == 83:  # leftmost+1 slider on minilab3
-            wave_i = int( (msg.value/127) * (len(waveforms)-1) )
-            print("wave_i:",wave_i)
-
+    while (msg := midi.receive()) is not None:  # drain everything pending
+        msg_handlers.get(type(msg), handle_none)(msg)
+    if cc_latest:
+        flush_cc()